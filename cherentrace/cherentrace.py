@@ -1,10 +1,35 @@
+import re
+import weakref
+
 import astropy.units as u
 import numpy as np
 import pandas as pd
 from astropy.coordinates import SkyCoord, AltAz, EarthLocation
 from astropy.time import Time
-from ctapipe.coordinates import TelescopeFrame
 
+# Used only to give the telescope pointing AltAz frame a location and time. The
+# simulations have no real observing time, so these are fixed once at import
+# rather than being looked up/constructed for every event
+_ROQUE = EarthLocation.from_geodetic(
+  lon = -17.8917*u.deg, lat = 28.7606*u.deg, height = 2326*u.m)
+_FIXED_OBSTIME = Time('2020-01-01T00:00:00', scale = 'utc')
+
+# Height (cm) from each OBSLEV line of a CORSIKA input card
+_OBSLEV_RE = re.compile(r'^[ \t]*OBSLEV[ \t]+(\S+)', flags = re.MULTILINE)
+
+# OBSLEV heights parsed from each open file's CORSIKA input card
+_OBSLEV_CACHE = weakref.WeakKeyDictionary()
+
+# Emitter fields that are unused (time, wavelength) or are placed next to the
+# photon directions (x, y) in get_photons
+_EMITTER_SKIP_FIELDS = ['x', 'y', 'time', 'wavelength']
+# Edits to CORSIKA/IACT and sim_telarray mean these will be ID and generation
+_EMITTER_RENAME = {'mass': 'particle_id', 'charge': 'generation'}
+
+# Lookup table of whether a particle ID is a muon, including the additional
+# muon information IDs. All of these are below 256, so clip IDs to 0-255 first
+_MUON_LUT = np.zeros(256, dtype = bool)
+_MUON_LUT[[5, 6, 75, 76, 85, 86, 95, 96]] = True
 
 def _assert_event_match(source, event):
   if (source.file_.header['run'] != event.index.obs_id
@@ -15,68 +40,177 @@ def _assert_event_match(source, event):
   else:
     pass
 
-def _find_paired_data(df, particle_id):
+def _find_paired_data_batch(df, particle_ids = (75, 76)):
   """Birth muon rows in the particle table (75, 76, 85, and 86) have a matching
   row immediately following them. This function looks up those rows and returns
   them. Sometimes, a few rows won't have a matching pair (possible CORSIKA
   bug?); this function does the extra checking necessary to confirm the match
   is correct. Indices of rows that don't have a match are also returned.
 
+  All of the requested particle IDs are handled in a single pass over the
+  table.
+
   Returns:
-    keep_idx :  Pandas Index of the birth muons that have a match
-    keep_vals:  Pandas DataFrame of the matching muon data for the birth muons
+    dict mapping each particle ID to a tuple of:
+    keep_pos :  Positions of the birth muons that have a match. The matching
+                muon row is at keep_pos + 1
     drop_idx :  Pandas Index of the birth muons that do not have a match
   """
-  if particle_id in [75, 76]:
-    expected_pid = particle_id - 70
-  elif particle_id in [85, 86]:
-    expected_pid = particle_id + 10
-  else:
-    raise RuntimeError(f"Unexpected particle ID: {particle_id}")
-
-  idx = df.query(f"particle_id == {particle_id}").index
-  paired_idx = idx + 1
-  found_idx = paired_idx.intersection(df.index)
-
-  found_pid = df.loc[found_idx, 'particle_id']
-  match_mask = found_pid == expected_pid
-
-  keep_idx = found_idx[match_mask] - 1
-  keep_vals = df.loc[found_idx[match_mask], :]
-  drop_idx = found_idx[~match_mask]
-
-  # Due to unknown reasons (maybe a CORSIKA bug?) sometimes the expected
-  # matching entry in the next row is not found in the table, or it has the
-  # wrong particle ID. There are usually only a handful of these and it
-  # shouldn't be a big problem
-  miss_idx = paired_idx.difference(df.index)
-  drop_idx = drop_idx.union(miss_idx)
-  if not drop_idx.empty:
-    print(
-      "Warning: No matching row found for muon entries with "
-      f"ID={particle_id}: {drop_idx.values}"
-    )
+  expected_pids = {}
+  for particle_id in particle_ids:
+    if particle_id in [75, 76]:
+      expected_pids[particle_id] = particle_id - 70
+    elif particle_id in [85, 86]:
+      expected_pids[particle_id] = particle_id + 10
+    else:
+      raise RuntimeError(f"Unexpected particle ID: {particle_id}")
+
+  pid = df['particle_id'].to_numpy()
+  labels = df.index.to_numpy()
+
+  # The row after row i is only a candidate pair if it directly followed it in
+  # the original table (i.e. it wasn't removed as a duplicate)
+  next_pid = np.full(len(df), -1, dtype = pid.dtype)
+  next_pid[:-1] = np.where(labels[1:] == labels[:-1] + 1, pid[1:], -1)
+
+  result = {}
+  for particle_id, expected_pid in expected_pids.items():
+    birth = pid == particle_id
+    paired = next_pid == expected_pid
+    keep_pos = np.flatnonzero(birth & paired)
+
+    # Due to unknown reasons (maybe a CORSIKA bug?) sometimes the expected
+    # matching entry in the next row is not found in the table, or it has the
+    # wrong particle ID. There are usually only a handful of these and it
+    # shouldn't be a big problem
+    drop_idx = df.index[np.flatnonzero(birth & ~paired)]
+    if not drop_idx.empty:
+      print(
+        "Warning: No matching row found for muon entries with "
+        f"ID={particle_id}: {drop_idx.values}"
+      )
+
+    result[particle_id] = (keep_pos, drop_idx)
+
+  return result
+
+def _drop_duplicate_particles(df):
+  """Drop rows of the particle table with the same cx, cy, momentum and time as
+  an earlier row, like drop_duplicates(keep = 'first'). The original index is
+  kept, since _find_paired_data_batch uses it to tell whether the row after a
+  birth muon was removed.
+
+  Each row's key columns are viewed as a single opaque value, so np.unique can
+  do a 1D sort instead of pandas hashing several columns. Signed zeros and NaN
+  payloads are normalised first so that they compare equal, as in pandas.
+  """
+  key = df[['cx', 'cy', 'momentum', 'time']].to_numpy() + 0 # -0.0 -> 0.0
+  key[np.isnan(key)] = np.nan
+  key = np.ascontiguousarray(key)
+  key = key.view(np.dtype((np.void, key.dtype.itemsize*key.shape[1]))).ravel()
+  _, first_pos = np.unique(key, return_index = True)
+  return df.take(np.sort(first_pos))
+
+def _get_obslev_offsets(obslevs, simshower):
+  """x/y offsets of each observation level from the shower frame of the lowest
+  level, for obslevs as returned by get_corsika_obslevs and the event's
+  simulated shower. Returned as a (2, n_obslevs) array of x and y offsets so
+  that both can be looked up with a single index.
+  """
+  alt = simshower.alt.to_value(u.rad)
+  az = simshower.az.to_value(u.rad)
+
+  tanth = np.tan(0.5*np.pi - alt)
+  dz = obslevs - obslevs[-1]
+  # float32 to match the precision of the particle table x/y coordinates
+  xyoff = np.empty((2, len(obslevs)), dtype = np.float32)
+  xyoff[0] = -1*dz*tanth*np.cos(az) # not sure why this needs the minus sign
+  xyoff[1] = dz*tanth*np.sin(az)
+  return xyoff
+
+def _camera_to_fov(cam_frame, x, y):
+  """Convert camera plane x/y (m) to telescope frame fov_lon/fov_lat (deg).
+
+  Follows ctapipe's CameraFrame -> TelescopeFrame transform (equidistant
+  optics: fov_lon = y/f, fov_lat = x/f after the camera rotation), applied
+  directly to NumPy arrays to avoid the overhead of building and transforming
+  a SkyCoord for every photon.
+  """
+  focal_length = cam_frame.focal_length.to_value(u.m)
+  rot = cam_frame.rotation.to_value(u.rad)
+  if rot != 0:
+    cosrot = np.cos(rot)
+    sinrot = np.sin(rot)
+    x, y = x*cosrot - y*sinrot, x*sinrot + y*cosrot
+
+  fov_lon = np.rad2deg(y/focal_length)
+  fov_lat = np.rad2deg(x/focal_length)
+  return fov_lon, fov_lat
+
+def _classify_particles(pid, gen, x, y, z, t, obs_level, fate_index, obslev_xy,
+  obslev_z):
+  """Decode the packed particle ID column of the particle table, filling in the
+  generation, observation level and muon fate index of each row, and offset
+  the x/y of standard particles according to their observation level.
+
+  pid, x, y, z and t are NumPy arrays of the table columns and are updated in
+  place: pid holds the raw CORSIKA particle ID and is replaced by the decoded
+  particle ID, and z should be pre-filled with NaN. gen, obs_level and
+  fate_index are output arrays, fully written here (-1 where not applicable).
+  obslev_xy (from _get_obslev_offsets) and obslev_z are read-only lookups.
+  """
+  raw_gen = pid % 1000
+  pid //= 1000
 
-  return keep_idx, keep_vals, drop_idx
+  # TODO: Add support for ID<0, which will be EHISTORY mother and grandmother
+  # particles
+  is_std = ((pid > 0) & (pid < 75)) | (pid > 100)
+  is_addi = (pid >= 75) & (pid <= 96)
+  is_fated = (pid >= 95) & (pid <= 96)
 
-def _get_obslev_offsets(source, event):
-  obslevs = get_corsika_obslevs(source)
-  simshower = event.simulation.shower
+  # For 0<ID<75,ID>100: gen number g, obs level number l: g×10 + l
+  # For ID=95/96: gen number g, muon fate index f: g×10 + f
+  # Decode both over the whole column and select per row, rather than masking
+  # out each group of rows first
+  sub_index = raw_gen % 10
+  gen[:] = np.where(is_std | is_fated, raw_gen // 10, raw_gen)
+  obs_level[:] = np.where(is_std, np.where(sub_index == 0, 10, sub_index), -1) # SPECIAL CASE OF 10 LEVELS
+  fate_index[:] = np.where(is_fated, sub_index, -1)
+  # fate index=1: Muon track ends because of decay
+  # fate index=2: Muon track ends because of nuclear fatal interaction
+  # fate index=3: Muon track ends in update by energy or angular cut
 
-  tanth = np.tan(90*u.deg - simshower.alt)
-  xoff = -1*(obslevs - obslevs[-1])*tanth*np.cos(simshower.az) # not sure why this needs the minus sign
-  yoff = (obslevs - obslevs[-1])*tanth*np.sin(simshower.az)
+  # Index of each row's level in the obslev arrays, converted once for all of
+  # the lookups
+  level_idx = obs_level[is_std].astype(np.intp) - 1
+  xoff, yoff = obslev_xy[:, level_idx]
+  x[is_std] -= xoff
+  y[is_std] -= yoff
+  z[is_std] = obslev_z[level_idx]
 
-  # Cast to float32 to match the precision of the particle table x/y coordinates
-  return {'x': xoff.value.astype(np.float32), 'y': yoff.value.astype(np.float32)}
+  z[is_addi] = t[is_addi]/100 # "time" is actually z in cm
+  t[is_addi] = np.nan
 
 def get_corsika_obslevs(source):
+  return _cached_corsika_obslevs(source).copy()
+
+def _cached_corsika_obslevs(source):
+  # The input card can't change for an open file, so only parse it once. The
+  # cached array is shared, so it's read-only
+  obslevs = _OBSLEV_CACHE.get(source.file_)
+  if obslevs is None:
+    obslevs = _parse_corsika_obslevs(source)
+    obslevs.flags.writeable = False
+    _OBSLEV_CACHE[source.file_] = obslevs
+  return obslevs
+
+def _parse_corsika_obslevs(source):
   input_card = source.file_.corsika_inputcards[0].decode('utf8')
-  input_card_wordlines = [[w for w in l.split(' ') if w] for l in input_card.split('\n') if l and l[0] != '*']
-  obslevs = sorted([float(l[1])/100 for l in input_card_wordlines if l and l[0] == 'OBSLEV'])
+  # Comment lines start with '*', so they never match
+  obslevs = np.sort([float(v) for v in _OBSLEV_RE.findall(input_card)])/100
   # OBSLEV 1 must be the highest level, OBSLEV n must be the lowest level
   # Cast to float32 to match the precision of the particle table z coordinate
-  return np.flip(np.asarray(obslevs, dtype = np.float32))
+  return np.flip(obslevs.astype(np.float32))
 
 def get_photons(source, event, tel_id, to_telescope_frame = True):
   """Return a Pandas DataFrame containing the Cherenkov photons that reached the
@@ -118,71 +252,56 @@ def get_photons(source, event, tel_id, to_telescope_frame = True):
       "sim_telarray was run with save_photons = 1 or greater. You must set "
       "save_photons = 0")
 
-  df_photons = pd.DataFrame(true_photons)
-  df_photons.rename(columns = {'photons': 'pixel_id'}, inplace = True)
-
-  df_photons.x = df_photons.x/100 # convert to m
-  df_photons.y = df_photons.y/100
-  df_photons.zem = df_photons.zem/100
-  df_photons.pixel_id = df_photons.pixel_id.astype(int)
+  x = true_photons['x']*np.float32(0.01) # convert to m
+  y = true_photons['y']*np.float32(0.01)
 
+  # Build each output column as an array, inserting them in their final order,
+  # and create the DataFrame once at the end
+  data = {}
   if to_telescope_frame:
     tel_pointing = SkyCoord(
       alt = event.pointing.tel[tel_id].altitude,
       az = event.pointing.tel[tel_id].azimuth,
       frame = AltAz(
-        obstime = Time.now(),
-        location = EarthLocation.of_site('Roque de los Muchachos'),
+        obstime = _FIXED_OBSTIME,
+        location = _ROQUE,
       ),
     )
     cam_frame = source.subarray.tels[tel_id].camera.geometry.frame
-    tel_frame = TelescopeFrame(telescope_pointing = tel_pointing)
-
-    photon_x = u.Quantity(df_photons.x, u.m)
-    photon_y = u.Quantity(df_photons.y, u.m)
-    coord = SkyCoord(photon_x, photon_y, frame = cam_frame)
-    trans = coord.transform_to(tel_frame)
-    df_photons.x = trans.fov_lon.to_value('deg')
-    df_photons.y = trans.fov_lat.to_value('deg')
-
-    arrival_dirs = tel_pointing.spherical_offsets_by(trans.fov_lon, trans.fov_lat)
-    df_photons['alt'] = arrival_dirs.alt.to_value('deg')
-    df_photons['az'] = arrival_dirs.az.to_value('deg')
-
-    new_col_order = [0, 1, 8, 9, 2, 3, 5, 4, 6, 7]
+    fov_lon, fov_lat = _camera_to_fov(cam_frame, x, y)
+    arrival_dirs = tel_pointing.spherical_offsets_by(
+      u.Quantity(fov_lon, u.deg), u.Quantity(fov_lat, u.deg))
+
+    data['x'] = fov_lon
+    data['y'] = fov_lat
+    data['alt'] = arrival_dirs.alt.to_value('deg')
+    data['az'] = arrival_dirs.az.to_value('deg')
   else:
-    new_col_order = [0, 1, 2, 3, 5, 4, 6, 7]
-
-  df_photons = df_photons[ df_photons.columns[new_col_order] ]
+    data['x'] = x
+    data['y'] = y
 
+  data['cx'] = true_photons['cx']
+  data['cy'] = true_photons['cy']
   if true_emitter is not None:
-    df_emitter = pd.DataFrame(true_emitter)
-    # Unused
-    df_emitter.drop(columns = ['time', 'wavelength'], inplace = True)
     # Edits to CORSIKA/IACT and sim_telarray mean these will be emission points
-    df_emitter.rename(columns = {'x': 'xem', 'y': 'yem'}, inplace = True)
-    df_emitter.xem = df_emitter.xem/100 # convert to m
-    df_emitter.yem = df_emitter.yem/100
-    df_emitter.emission_time = df_emitter.emission_time*1e9 # convert to ns
-    # Edits to CORSIKA/IACT and sim_telarray mean these will be ID and generation
-    df_emitter.rename(columns = {'mass': 'particle_id', 'charge': 'generation'}, inplace = True)
-    df_emitter.particle_id = df_emitter.particle_id.astype(int)
-    df_emitter.generation = df_emitter.generation.astype(int)
-
-    df_emitter['is_muon'] = False
-    df_emitter.loc[df_emitter.query("particle_id in [5, 6]").index, 'is_muon'] = True
-
-    # Zip emitter data with photon data
-    df_photons = pd.concat([df_photons, df_emitter], axis = 'columns')
-
-    if to_telescope_frame:
-      new_col_order = [0, 1, 2, 3, 4, 5, 10, 11, 6, 7, 8, 9, 12, 13, 14, 15, 16]
-    else:
-      new_col_order = [0, 1, 2, 3, 8, 9, 4, 5, 6, 7, 10, 11, 12, 13, 14]
+    data['xem'] = true_emitter['x']*np.float32(0.01) # convert to m
+    data['yem'] = true_emitter['y']*np.float32(0.01)
+  data['zem'] = true_photons['zem']*np.float32(0.01)
+  data['time'] = true_photons['time']
+  data['pixel_id'] = true_photons['photons'].astype(np.int32)
+  data['wavelength'] = true_photons['wavelength']
 
-    df_photons = df_photons[ df_photons.columns[new_col_order] ]
+  if true_emitter is not None:
+    # The remaining emitter fields go at the end, in the order they're stored
+    for name in true_emitter.dtype.names:
+      if name not in _EMITTER_SKIP_FIELDS:
+        data[_EMITTER_RENAME.get(name, name)] = true_emitter[name]
+    data['emission_time'] = true_emitter['emission_time']*1e9 # convert to ns
+    data['particle_id'] = data['particle_id'].astype(int)
+    data['generation'] = data['generation'].astype(int)
+    data['is_muon'] = np.isin(data['particle_id'], [5, 6])
 
-  return df_photons
+  return pd.DataFrame(data)
 
 def get_particles(source, event):
   """Return a Pandas DataFrame containing the particles that passed through
@@ -208,62 +327,60 @@ def get_particles(source, event):
   if obslev_particles is None:
     return None
 
-  obslev_z = get_corsika_obslevs(source)
-  obslev_xy = _get_obslev_offsets(source, event)
+  obslev_z = _cached_corsika_obslevs(source)
+  obslev_xy = _get_obslev_offsets(obslev_z, event.simulation.shower)
 
   df = pd.DataFrame(obslev_particles)
-  df.drop_duplicates( # Remove duplicate 75/76 entries, which can also overlap with 85/86
-    subset = ['cx', 'cy', 'momentum', 'time'],
-    keep = 'first', inplace = True)
+  # Remove duplicate 75/76 entries, which can also overlap with 85/86
+  df = _drop_duplicate_particles(df)
   df.x = df.x/100 # convert to m
   df.y = df.y/100
-  df['cz'] = -1*np.sqrt(1 - df.cx**2 - df.cy**2) # downwards
-
-  df['z'] = np.nan
-  df['obs_level'] = -1
-  df['fate_index'] = -1
-  df['generation'] = (df.particle_id % 1000).astype(int)
-  df.particle_id = ((df.particle_id - df.generation) / 1000).astype(int)
-
-  # TODO: Add support for ID<0, which will be EHISTORY mother and grandmother
-  # particles
-
-  # For 0<ID<75,ID>100: gen number g, obs level number l: g×10 + l
-  std_part = df.query("(particle_id > 0 and particle_id < 75) or particle_id > 100")
-  _obs_level = std_part.generation % 10
-  _generation = (std_part.generation - _obs_level) / 10 # Must be before the next line
-  _obs_level = _obs_level.mask(_obs_level == 0, other = 10) # SPECIAL CASE OF 10 LEVELS
-  df.loc[std_part.index, 'obs_level'] = _obs_level.astype(int)
-  df.loc[std_part.index, 'generation'] = _generation.astype(int)
-  df.loc[std_part.index, 'x'] = std_part.x - obslev_xy['x'][_obs_level - 1]
-  df.loc[std_part.index, 'y'] = std_part.y - obslev_xy['y'][_obs_level - 1]
-  df.loc[std_part.index, 'z'] = obslev_z[_obs_level - 1]
-
-  addi_muon = df.query("75 <= particle_id <= 96")
-  df.loc[addi_muon.index, 'z'] = addi_muon.time/100 # "time" is actually z in cm
-  df.loc[addi_muon.index, 'time'] = np.nan
+  # cz = -sqrt(1 - cx² - cy²) (downwards), computed in one reused buffer
+  cx = df['cx'].to_numpy()
+  cy = df['cy'].to_numpy()
+  cz = np.multiply(cx, cx)
+  cz += np.multiply(cy, cy)
+  np.subtract(1, cz, out = cz)
+  np.sqrt(cz, out = cz)
+  np.negative(cz, out = cz)
+  df['cz'] = cz
+
+  # Decode and fill in the table on plain arrays, and write the columns back
+  # to the DataFrame once at the end rather than through many .loc setitems
+  n = len(df)
+  pid = df['particle_id'].to_numpy(dtype = np.int64, copy = True)
+  x_arr = df['x'].to_numpy(copy = True)
+  y_arr = df['y'].to_numpy(copy = True)
+  t_arr = df['time'].to_numpy(copy = True)
+  z_arr = np.full(n, np.nan, dtype = np.float32)
+  ol_arr = np.empty(n, dtype = np.int16)
+  fi_arr = np.empty(n, dtype = np.int8)
+  gen_arr = np.empty(n, dtype = np.int16)
+  _classify_particles(pid, gen_arr, x_arr, y_arr, z_arr, t_arr, ol_arr, fi_arr,
+    obslev_xy, obslev_z)
+  df['particle_id'] = pid
 
   # For ID=75/76 we need to offset x/y according to the observation level of the
   # matching 5/6 in the next row
-  for pid in [75, 76]:
-    keep_idx,keep_vals,drop_idx = _find_paired_data(df, pid)
-    _obs_level = keep_vals.obs_level
-    birth_muon = df.loc[keep_idx, :]
-    df.loc[birth_muon.index, 'x'] = birth_muon.x - obslev_xy['x'][_obs_level - 1]
-    df.loc[birth_muon.index, 'y'] = birth_muon.y - obslev_xy['y'][_obs_level - 1]
-
-  # For ID=95/96: gen number g, muon fate index f: g×10 + f
-  fated_muon = df.query("95 <= particle_id <= 96")
-  _fate_index = fated_muon.generation % 10
-  _generation = (fated_muon.generation - _fate_index) / 10
-  df.loc[fated_muon.index, 'fate_index'] = _fate_index.astype(int)
-  df.loc[fated_muon.index, 'generation'] = _generation.astype(int)
-  # fate index=1: Muon track ends because of decay
-  # fate index=2: Muon track ends because of nuclear fatal interaction
-  # fate index=3: Muon track ends in update by energy or angular cut
-
-  df['is_muon'] = False
-  df.loc[df.query("particle_id in [5, 6, 75, 76, 85, 86, 95, 96]").index, 'is_muon'] = True
+  paired_data = _find_paired_data_batch(df, (75, 76))
+  for keep_pos,_ in paired_data.values():
+    level_idx = ol_arr[keep_pos + 1].astype(np.intp) - 1
+    xoff, yoff = obslev_xy[:, level_idx]
+    x_arr[keep_pos] -= xoff
+    y_arr[keep_pos] -= yoff
+
+  df['x'] = x_arr
+  df['y'] = y_arr
+  df['time'] = t_arr
+  # Add the new columns in one go rather than inserting them one at a time
+  extra = pd.DataFrame({
+    'z': z_arr,
+    'obs_level': ol_arr,
+    'fate_index': fi_arr,
+    'generation': gen_arr,
+    'is_muon': _MUON_LUT[np.clip(pid, 0, 255)],
+  }, index = df.index)
+  df = pd.concat([df, extra], axis = 'columns')
 
   new_col_order = [0, 1, 9, 2, 3, 8, 4, 5, 6, 7, 10, 11, 12, 13]
   df = df[ df.columns[new_col_order] ]
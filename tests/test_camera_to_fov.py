@@ -0,0 +1,29 @@
+import astropy.units as u
+import numpy as np
+import pytest
+
+pytest.importorskip("ctapipe")
+
+from astropy.coordinates import AltAz, SkyCoord
+from ctapipe.coordinates import CameraFrame, TelescopeFrame
+
+from cherentrace.cherentrace import _camera_to_fov
+
+
+@pytest.mark.parametrize("rotation", [0.0, 10.9, -100.0])
+def test_camera_to_fov_matches_ctapipe(rotation):
+  pointing = SkyCoord(alt = 70*u.deg, az = 20*u.deg, frame = AltAz())
+  cam_frame = CameraFrame(
+    focal_length = 28*u.m,
+    rotation = rotation*u.deg,
+    telescope_pointing = pointing,
+  )
+  x = np.array([0.0, 0.3, -0.5, 1.1, -0.9])
+  y = np.array([0.0, -0.2, 0.7, 0.4, -1.2])
+
+  expected = SkyCoord(x*u.m, y*u.m, frame = cam_frame).transform_to(
+    TelescopeFrame(telescope_pointing = pointing))
+  fov_lon, fov_lat = _camera_to_fov(cam_frame, x, y)
+
+  np.testing.assert_allclose(fov_lon, expected.fov_lon.to_value(u.deg), atol = 1e-10)
+  np.testing.assert_allclose(fov_lat, expected.fov_lat.to_value(u.deg), atol = 1e-10)
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("astropy")
+
+from cherentrace.cherentrace import _drop_duplicate_particles, _find_paired_data_batch
+
+
+def _nan_with_payload(payload):
+  return np.array([0x7fc00000 | payload], dtype = np.uint32).view(np.float32)[0]
+
+
+def test_drop_duplicate_particles():
+  df = pd.DataFrame({
+    'particle_id': [75, 5, 76, 6, 6, 95, 95, 1, 1],
+    'cx': np.array([0.1, 0.2, 0.3, 0.2, 0.4, 0.0, -0.0, 0.5, 0.5], dtype = np.float32),
+    'cy': np.array([0.1, 0.2, 0.3, 0.2, 0.4, 0.0, 0.0, 0.5, 0.5], dtype = np.float32),
+    'momentum': np.array([1, 2, 3, 2, 4, 5, 5, 6, 6], dtype = np.float32),
+    'time': np.array([1, 2, 3, 2, 4, 5, 5, _nan_with_payload(1),
+      _nan_with_payload(2)], dtype = np.float32),
+  })
+
+  result = _drop_duplicate_particles(df)
+
+  # Same rows as pandas drops, with the original index kept
+  expected = df.drop_duplicates(subset = ['cx', 'cy', 'momentum', 'time'])
+  assert list(result.index) == [0, 1, 2, 4, 5, 7]
+  assert list(result.index) == list(expected.index)
+
+  # The 6 after the 76 birth muon was removed, so the next remaining row must not
+  # be taken as its pair
+  paired = _find_paired_data_batch(result, (75, 76))
+  keep_pos, drop_idx = paired[75]
+  assert list(keep_pos) == [0]
+  assert drop_idx.empty
+  keep_pos, drop_idx = paired[76]
+  assert len(keep_pos) == 0
+  assert list(drop_idx) == [2]
+
+
+def test_classify_particles():
+  from cherentrace.cherentrace import _classify_particles
+
+  pid = np.array([
+    5030,  # pid 5, generation 3, level digit 0 -> level 10
+    1012,  # pid 1, generation 1, level 2
+    95042, # pid 95, generation 4, fate index 2
+    75007, # pid 75, generation 7
+  ], dtype = np.int64)
+  n = len(pid)
+  x = np.array([10, 20, 30, 40], dtype = np.float32)
+  y = np.array([1, 2, 3, 4], dtype = np.float32)
+  t = np.array([5, 6, 700, 800], dtype = np.float32)
+  z = np.full(n, np.nan, dtype = np.float32)
+  gen = np.empty(n, dtype = np.int16)
+  obs_level = np.empty(n, dtype = np.int16)
+  fate_index = np.empty(n, dtype = np.int8)
+
+  obslev_z = np.linspace(3000, 2100, 10).astype(np.float32)
+  obslev_xy = np.zeros((2, 10), dtype = np.float32)
+  obslev_xy[:, 1] = [0.5, -0.5]
+  obslev_xy[:, 9] = [2.0, 3.0]
+
+  _classify_particles(pid, gen, x, y, z, t, obs_level, fate_index, obslev_xy,
+    obslev_z)
+
+  np.testing.assert_array_equal(pid, [5, 1, 95, 75])
+  np.testing.assert_array_equal(gen, [3, 1, 4, 7])
+  np.testing.assert_array_equal(obs_level, [10, 2, -1, -1])
+  np.testing.assert_array_equal(fate_index, [-1, -1, 2, -1])
+
+  # Standard particles are offset and placed at their observation level
+  np.testing.assert_allclose(x, [8, 19.5, 30, 40])
+  np.testing.assert_allclose(y, [-2, 2.5, 3, 4])
+  np.testing.assert_allclose(z[:2], [obslev_z[9], obslev_z[1]])
+  np.testing.assert_allclose(t[:2], [5, 6])
+
+  # For the additional muon IDs, "time" is really z in cm
+  np.testing.assert_allclose(z[2:], [7, 8])
+  assert np.all(np.isnan(t[2:]))